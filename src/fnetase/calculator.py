@@ -18,8 +18,8 @@ import os
 import h5py
 import hsd
 import numpy as np
-from ase.calculators.calculator import FileIOCalculator
-from fortformat import Fnetdata, Fnetout
+from ase.calculators.calculator import FileIOCalculator, all_changes
+from fortformat import Fnetout
 from .common import FortnetAseError
 
 
@@ -29,9 +29,11 @@ BOHR_AA = 0.529177249
 AA_BOHR = 1.0 / BOHR_AA
 HARTREE_EV = 27.2113845
 EV_HARTREE = 1.0 / HARTREE_EV
+# Hartree/Bohr --> eV/Angstrom
+FORCE_CONV = HARTREE_EV / BOHR_AA
 
-ELEMENTSYMBOL = ['h', 'he', 'li', 'be', 'b', 'c', 'n', 'o', 'f', 'ne',
-                 'na', 'mg', 'al', 'si', 'p ', 's ', 'cl', 'ar', 'k', 'ca',
+ELEMENTSYMBOL = ('h', 'he', 'li', 'be', 'b', 'c', 'n', 'o', 'f', 'ne',
+                 'na', 'mg', 'al', 'si', 'p', 's', 'cl', 'ar', 'k', 'ca',
                  'sc', 'ti', 'v', 'cr', 'mn', 'fe', 'co', 'ni', 'cu', 'zn',
                  'ga', 'ge', 'as', 'se', 'br', 'kr', 'rb', 'sr', 'y', 'zr',
                  'nb', 'mo', 'tc', 'ru', 'rh', 'pd', 'ag', 'cd', 'in', 'sn',
@@ -41,7 +43,10 @@ ELEMENTSYMBOL = ['h', 'he', 'li', 'be', 'b', 'c', 'n', 'o', 'f', 'ne',
                  'tl', 'pb', 'bi', 'po', 'at', 'rn', 'fr', 'ra', 'ac', 'th',
                  'pa', 'u', 'np', 'pu', 'am', 'cm', 'bk', 'cf', 'es', 'fm',
                  'md', 'no', 'lr', 'rf', 'db', 'sg', 'bh', 'hs', 'mt', 'ds',
-                 'rg', 'cn', 'nh', 'fl', 'mc', 'lv', 'ts', 'og']
+                 'rg', 'cn', 'nh', 'fl', 'mc', 'lv', 'ts', 'og')
+
+# element symbols, vectorially indexable by atomic number - 1
+_SYMBOL_ARR = np.array(ELEMENTSYMBOL)
 
 FNETDATA = 'fnetdata.hdf5'
 FNETOUT = 'fnetout.hdf5'
@@ -77,6 +82,28 @@ def hsd_to_file(inp, fname):
     hsd.dump(inp, fname)
 
 
+def open_hdf5(fname):
+    '''Opens an HDF5 file for reading, preferring SWMR mode and the latest
+       file format (cheaper metadata parsing), if supported by the file.
+
+    Args:
+
+        fname (str): name of HDF5 file to open
+
+    Returns:
+
+        fid (h5py.File): read-only file handle
+
+    '''
+
+    try:
+        fid = h5py.File(fname, 'r', libver='latest', swmr=True)
+    except (OSError, ValueError):
+        fid = h5py.File(fname, 'r')
+
+    return fid
+
+
 def get_fortnet_input(netstat, finitediffdelta, forces):
     '''Generates a suitable Python dictionary for a prediction run of Fortnet.
 
@@ -122,6 +149,162 @@ def get_fortnet_input(netstat, finitediffdelta, forces):
     return fnetinp
 
 
+def write_fnetdata(atoms, fname):
+    '''Streams a minimal prediction dataset of geometries to disk.
+
+    The file layout matches the one of fortformat's Fnetdata.dump(), but each
+    geometry is written directly to disk, instead of building the processed
+    representation of all geometries in memory first.
+
+    Args:
+
+        atoms (list): list of ASE atoms objects, containing the geometries
+            of the prediction dataset to be used
+        fname (str): name of dataset file to write
+
+    '''
+
+    # unique atomic numbers of the whole dataset, sorted in ascending order
+    zz = np.unique(np.concatenate(
+        [entry.get_atomic_numbers() for entry in atoms]))
+
+    # unlink instead of truncating, as the previous file may still be open
+    # (e.g. kept for in-place updates by another calculator)
+    if os.path.isfile(fname):
+        os.remove(fname)
+
+    with h5py.File(fname, 'w') as fid:
+        datagrp = fid.create_group('fnetdata/dataset')
+        datagrp.attrs['ndatapoints'] = len(atoms)
+        datagrp.attrs['nextfeatures'] = 0
+        datagrp.attrs['withstructures'] = 1
+        datagrp.attrs['ntotatoms'] = sum(len(entry) for entry in atoms)
+        _create_dataset(datagrp, 'atomicnumbers', zz, 'int')
+
+        traingrp = datagrp.create_group('training')
+        traingrp.attrs['nglobaltargets'] = 0
+        traingrp.attrs['natomictargets'] = 0
+
+        for isys, entry in enumerate(atoms):
+            subroot = datagrp.create_group('datapoint{}'.format(isys + 1))
+            _write_geometry(subroot, entry, zz)
+
+
+def update_fnetdata_coordinates(atoms, fid):
+    '''Overwrites the coordinates of a single geometry dataset in-place.
+
+    Args:
+
+        atoms (ASE atoms): geometry with (solely) updated positions
+        fid (h5py.File): writeable handle of the dataset file to update
+
+    '''
+
+    coords = fid['fnetdata/dataset/datapoint1/geometry/coordinates']
+    if atoms.get_pbc().all():
+        coords[...] = atoms.get_scaled_positions()
+    else:
+        # dataset expects coordinates in Bohr
+        coords[...] = atoms.get_positions() * AA_BOHR
+
+    # make the update visible to Fortnet, while keeping the file open
+    fid.flush()
+
+
+def _write_geometry(root, atoms, zz):
+    '''Writes a single geometry (and its default weights) to an hdf group.
+
+    Args:
+
+        root (hdf group): datapoint group to write to
+        atoms (ASE atoms): geometry of the current datapoint
+        zz (1darray): unique atomic numbers of the dataset
+
+    '''
+
+    pbc = atoms.get_pbc()
+    if pbc.all():
+        periodic = True
+    elif not pbc.any():
+        periodic = False
+    else:
+        msg = 'Error while writing ' + FNETDATA + ' file. Currently, only ' + \
+            'uniform pbc are supported.'
+        raise FortnetAseError(msg)
+
+    atomicnumbers = atoms.get_atomic_numbers()
+    symbols = list(atoms.symbols)
+
+    # local species indices in order of first appearance (Fortran indexing)
+    atomtospecies = {}
+    for species in symbols:
+        atomtospecies.setdefault(species, len(atomtospecies) + 1)
+    localattolocalsp = np.array([atomtospecies[species]
+                                 for species in symbols], dtype=int)
+    localattoglobalsp = np.searchsorted(zz, atomicnumbers) + 1
+
+    root.attrs['weight'] = 1
+    _create_dataset(root, 'atomicweights', np.ones(len(atoms)), 'float')
+
+    geogrp = root.create_group('geometry')
+    geogrp.attrs['fractional'] = int(periodic)
+    geogrp.attrs['localtypes'] = ','.join(atomtospecies)
+    geogrp.attrs['periodic'] = int(periodic)
+
+    _create_dataset(geogrp, 'localattolocalsp', localattolocalsp, 'int')
+    _create_dataset(geogrp, 'localattoglobalsp', localattoglobalsp, 'int')
+    _create_dataset(geogrp, 'localattoatnum', atomicnumbers, 'int')
+
+    if periodic:
+        _create_dataset(geogrp, 'coordinates', atoms.get_scaled_positions(),
+                        'float')
+        # dataset expects lattice vectors in Bohr
+        _create_dataset(geogrp, 'basis', atoms.get_cell()[:, :] * AA_BOHR,
+                        'float')
+    else:
+        # dataset expects coordinates in Bohr
+        _create_dataset(geogrp, 'coordinates',
+                        atoms.get_positions() * AA_BOHR, 'float')
+
+
+def _file_stat(fname):
+    '''Summarizes the status of a file to detect modifications.
+
+    Args:
+
+        fname (str): path to the file
+
+    Returns:
+
+        stat (tuple): inode, modification time and size or None if absent
+
+    '''
+
+    try:
+        stat = os.stat(fname)
+    except FileNotFoundError:
+        return None
+
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def _create_dataset(root, name, data, dtype):
+    '''Creates a contiguous dataset and writes data into it.
+
+    Args:
+
+        root (hdf group): hdf group to create the dataset in
+        name (str): name of the dataset
+        data (ndarray): data to write
+        dtype (str): datatype of the dataset
+
+    '''
+
+    dset = root.create_dataset(name, data.shape, dtype=dtype,
+                               track_times=False)
+    dset[...] = data
+
+
 def _check_bpnn_configuration(fname, tforces):
     '''Checks a given Netstat file for compliance with ASE's expectations.
 
@@ -132,7 +315,7 @@ def _check_bpnn_configuration(fname, tforces):
 
     '''
 
-    with h5py.File(fname, 'r') as netstatfile:
+    with open_hdf5(fname) as netstatfile:
         netstat = netstatfile['netstat']
         # currently only the BPNN topology is allowed
         if 'netstat/bpnn' in netstatfile:
@@ -166,14 +349,23 @@ def _check_bpnn_configuration(fname, tforces):
                 " are supported."
             raise FortnetAseError(msg)
 
-        atomicnumbers = np.sort(np.array(bpnn['atomicnumbers'], dtype=int))
+        atomicnumbers = np.asarray(bpnn['atomicnumbers'], dtype=np.intp)
+        elements = _SYMBOL_ARR[atomicnumbers - 1]
+
+        # resolve subnetwork names at once instead of one lookup per element
+        expected = {element + '-subnetwork' for element in elements}
+        missing = expected - set(bpnn.keys())
+        if missing:
+            msg = "Error while reading netstat file '" + fname + \
+                "'. Missing subnetwork(s): " + ', '.join(sorted(missing)) + \
+                "."
+            raise FortnetAseError(msg)
 
-        for atnum in atomicnumbers:
-            element = ELEMENTSYMBOL[atnum - 1]
-            subnet = bpnn[element.strip() + '-subnetwork']
-            topology = np.array(subnet['topology'], dtype=int)
+        for subnet in expected:
+            # only the output layer size is of interest, avoid full read
+            last = int(bpnn[subnet]['topology'][-1])
 
-            if topology[-1] != 1:
+            if last != 1:
                 msg = "Error while reading netstat file '" + fname + \
                     "'. Only networks trained on a single global property" + \
                     " are supported."
@@ -221,6 +413,9 @@ class Fortnet(FileIOCalculator):
             finitediffdelta (float): coordinate shift to calculate central
                 finite differences (unit: Angstrom)
             forces (bool): true, if forces shall be calculated by Fortnet
+            truncate_fnetout (bool): true, if the fnetout.hdf5 output shall be
+                truncated instead of deleted after reading it, keeping its
+                inode to be overwritten by the next run (default: True)
 
         '''
 
@@ -229,6 +424,20 @@ class Fortnet(FileIOCalculator):
         self.do_forces = False
         self.outfilename = 'fortnet.out'
 
+        # (netstat, mtime, forces) key of the last successful netstat check
+        self._bpnn_checked = None
+
+        # whether the dataset on disk holds a single geometry, i.e. may be
+        # updated in-place
+        self._fnetdata_single = False
+
+        # dataset handle, kept open across steps for in-place updates, and
+        # the file status after the last write to detect foreign changes
+        self._fnetdata_handle = None
+        self._fnetdata_stat = None
+
+        self._truncate_fnetout = kwargs.get('truncate_fnetout', True)
+
         # determine coordinate shift for finite differences
         if 'finitediffdelta' in kwargs:
             # expect coordinate shift in ASE units, i.e. Angstrom
@@ -263,9 +472,56 @@ class Fortnet(FileIOCalculator):
         return inp
 
 
+    def _check_netstat(self):
+        '''Validates the netstat file, unless the file and force flag are
+           unchanged since the last successful check.
+        '''
+
+        key = (self._netstat, os.path.getmtime(self._netstat), self.do_forces)
+        if key != self._bpnn_checked:
+            _check_bpnn_configuration(self._netstat, self.do_forces)
+            self._bpnn_checked = key
+
+
+    def __del__(self):
+        '''Closes HDF5 file handles kept open across steps.'''
+
+        self._close_fnetdata()
+
+
+    def _close_fnetdata(self):
+        '''Closes the dataset handle kept open for in-place updates.'''
+
+        if getattr(self, '_fnetdata_handle', None) is not None:
+            self._fnetdata_handle.close()
+            self._fnetdata_handle = None
+
+
+    def _get_fnetdata_handle(self):
+        '''Provides a writeable dataset file handle, opened on first use.
+
+        Since Fortnet reads the dataset while the handle is open, HDF5 file
+        locking is disabled and every update is flushed to disk.
+
+        Returns:
+
+            handle (h5py.File): writeable handle of the dataset file
+
+        '''
+
+        if self._fnetdata_handle is None:
+            self._fnetdata_handle = h5py.File(FNETDATA, 'r+', locking=False)
+
+        return self._fnetdata_handle
+
+
     def check_state(self, atoms):
         '''Checks the current state of the FileIOCalculator.'''
 
+        # results of a batched prediction never apply to a single geometry
+        if isinstance(self.atoms, list):
+            return list(all_changes)
+
         system_changes = FileIOCalculator.check_state(self, atoms)
         # Ignore unit cell for molecules:
         if not atoms.pbc.any() and 'cell' in system_changes:
@@ -281,7 +537,7 @@ class Fortnet(FileIOCalculator):
             if 'forces' in properties:
                 self.do_forces = True
 
-        _check_bpnn_configuration(self._netstat, self.do_forces)
+        self._check_netstat()
 
         FileIOCalculator.write_input(self, atoms, properties, system_changes)
 
@@ -289,12 +545,21 @@ class Fortnet(FileIOCalculator):
         inp = self._get_fortnet_input()
         hsd_to_file(inp, 'fortnet_in.hsd')
 
-        # generate minimal dataset and dump to disk
-        if atoms is not None and not isinstance(atoms, list):
-            fnetdata = Fnetdata(atoms=[atoms])
+        # generate minimal dataset and dump to disk, if only the positions
+        # changed, the coordinates of the present dataset are overwritten
+        single = atoms is not None and not isinstance(atoms, list)
+        if single and self._fnetdata_single and system_changes is not None \
+           and set(system_changes) <= {'positions'} \
+           and _file_stat(FNETDATA) == self._fnetdata_stat:
+            update_fnetdata_coordinates(atoms, self._get_fnetdata_handle())
+        elif single:
+            self._close_fnetdata()
+            write_fnetdata([atoms], FNETDATA)
         else:
-            fnetdata = Fnetdata(atoms=atoms)
-        fnetdata.dump(FNETDATA)
+            self._close_fnetdata()
+            write_fnetdata(atoms, FNETDATA)
+        self._fnetdata_single = single
+        self._fnetdata_stat = _file_stat(FNETDATA)
 
         # self.atoms is none until results are read out,
         # then it is set to the ones at writing input
@@ -302,56 +567,252 @@ class Fortnet(FileIOCalculator):
         self.atoms = None
 
 
+    def calculate_batch(self, images, properties=('energy',)):
+        '''Predicts a list of geometries within a single Fortnet run.
+
+        Args:
+
+            images (list): list of ASE atoms objects to predict
+            properties (tuple): properties to calculate
+
+        Returns:
+
+            results (dict): energies (1darray) and, if requested, forces
+                (list of 2darrays), indexed by image
+
+        The calculator is reset afterwards, since batched results don't
+        apply to a single geometry, e.g. get_potential_energy().
+
+        '''
+
+        images = list(images)
+        if not images:
+            raise FortnetAseError('Empty list of images to predict.')
+
+        FileIOCalculator.calculate(self, images, properties, all_changes)
+
+        results = self.results
+        self.reset()
+
+        return results
+
+
     def read_results(self):
         '''All results are read from the fnetout.hdf5 file.
-           It will be destroyed after it is read to avoid
-           reading it once again after some runtime error.
+           It will be truncated (or destroyed) after it is read to
+           avoid reading it once again after some runtime error.
         '''
 
         self.atoms = self.atoms_input
 
-        # read energy from fnetdata.hdf5 output
-        self.results['energy'] = read_energy()
+        if isinstance(self.atoms_input, list):
+            # batched prediction, results are indexed by image
+            energy, forces = _read_fnetout_batch(self.do_forces)
+        else:
+            # read energy and forces from fnetout.hdf5 output in a single pass
+            energy, forces = _read_fnetout(self.do_forces)
 
-        # read forces from fnetdata.hdf5 output
+        self.results['energy'] = energy
         if self.do_forces:
-            self.results['forces'] = read_forces(self.do_forces)
+            self.results['forces'] = forces
+
+        fnetoutpath = os.path.join(self.directory, FNETOUT)
+        if self._truncate_fnetout:
+            with open(fnetoutpath, 'wb'):
+                pass
+        else:
+            os.remove(fnetoutpath)
+
+
+def _read_fnetout(tforces):
+    '''Read energy and (optionally) forces from fnetout.hdf5 output, while
+       opening the file only once and bypassing the Fnetout wrapper.
+
+    Args:
+
+        tforces (bool): true, if forces are expected to be present
+
+    Returns:
+
+        energy (float): system-wide energy prediction (unit: eV)
+        forces (2darray): atomic forces (unit: eV/Angstrom) or None
+
+    '''
+
+    with open_hdf5(FNETOUT) as fnetoutfile:
+        output = fnetoutfile['fnetout/output']
+
+        energy = read_energy(fnetoutfile)
+
+        _check_output_forces(output, tforces)
+
+        if tforces:
+            # assume a single datapoint and training target
+            # further assume that the target unit was a.u.
+            forces = _read_forces_direct(output)
+            np.multiply(forces, FORCE_CONV, out=forces)
+        else:
+            forces = None
+
+    return energy, forces
+
+
+def _read_fnetout_batch(tforces):
+    '''Read energies and (optionally) forces of all datapoints from
+       fnetout.hdf5 output.
+
+    Args:
+
+        tforces (bool): true, if forces are expected to be present
+
+    Returns:
+
+        energies (1darray): system-wide energy predictions (unit: eV)
+        forces (list): atomic forces (unit: eV/Angstrom) or None
+
+    '''
+
+    with open_hdf5(FNETOUT) as fnetoutfile:
+        output = fnetoutfile['fnetout']['output']
+        ndatapoints = int(output.attrs['ndatapoints'][0])
+
+        _check_output_forces(output, tforces)
+
+        # assume a single system-wide energy prediction per datapoint
+        # further assume that the target unit was a.u.
+        energies = np.empty(ndatapoints, dtype=float)
+        forces = [] if tforces else None
+
+        for idata in range(ndatapoints):
+            datapoint = output['datapoint' + str(idata + 1)]
+            energies[idata] = datapoint['globalpredictions'][0]
+            if tforces:
+                entry = datapoint['forces'][:, 0:3]
+                np.multiply(entry, FORCE_CONV, out=entry)
+                forces.append(entry)
+
+    np.multiply(energies, HARTREE_EV, out=energies)
 
-        os.remove(os.path.join(self.directory, FNETOUT))
+    return energies, forces
 
 
-def read_energy():
-    '''Read energy from fnetout.hdf5 output.'''
+def read_energy(fnetout=None):
+    '''Read energy from fnetout.hdf5 output.
+
+    Args:
+
+        fnetout (Fnetout or h5py.File): already opened fnetout.hdf5 output
+            to reuse, the file is opened if None
+
+    '''
+
+    if fnetout is None:
+        with open_hdf5(FNETOUT) as fnetoutfile:
+            return read_energy(fnetoutfile)
 
-    fnetout = Fnetout(FNETOUT)
     # assume a single system-wide energy prediction
     # further assume that the target unit was a.u.
-    energy = fnetout.globalpredictions[0, 0] * HARTREE_EV
+    if isinstance(fnetout, Fnetout):
+        energy = fnetout.globalpredictions[0, 0] * HARTREE_EV
+    else:
+        output = fnetout['fnetout/output']
+        energy = float(output['datapoint1/globalpredictions'][0]) \
+            * HARTREE_EV
 
     return energy
 
 
-def read_forces(tforces):
+def read_forces(tforces, fnetout=None):
     '''Read forces from fnetout.hdf5 output.
 
     Args:
 
         tforces (bool): true, if forces are expected to be present
+        fnetout (Fnetout or h5py.File): already opened fnetout.hdf5 output
+            to reuse, the file is opened if None
 
     '''
 
-    fnetout = Fnetout(FNETOUT)
+    if fnetout is None:
+        with open_hdf5(FNETOUT) as fnetoutfile:
+            return read_forces(tforces, fnetoutfile)
 
-    if tforces and not fnetout.tforces:
+    if isinstance(fnetout, Fnetout):
+        output = fnetout
+    else:
+        output = fnetout['fnetout/output']
+
+    _check_output_forces(output, tforces)
+
+    if not tforces:
+        return None
+
+    # assume a single datapoint and training target
+    # further assume that the target unit was a.u.
+    if isinstance(fnetout, Fnetout):
+        forces = fnetout.forces[0][0]
+    else:
+        forces = _read_forces_direct(output)
+    np.multiply(forces, FORCE_CONV, out=forces)
+
+    return forces
+
+
+def _output_has_forces(output):
+    '''Checks whether forces are present in fnetout.hdf5 output.
+
+    Args:
+
+        output (hdf group): output group of the fnetout.hdf5 file
+
+    Returns:
+
+        present (bool): true, if atomic forces are supplied
+
+    '''
+
+    # account for legacy files where no force entry is present
+    return bool(output.attrs.get('tforces', [0])[0])
+
+
+def _check_output_forces(output, tforces):
+    '''Checks whether forces are present in fnetout.hdf5 output, if requested.
+
+    Args:
+
+        output (hdf group or Fnetout): output group of the fnetout.hdf5 file
+            or the corresponding Fnetout wrapper
+        tforces (bool): true, if forces are expected to be present
+
+    '''
+
+    if isinstance(output, Fnetout):
+        present = output.tforces
+    else:
+        present = _output_has_forces(output)
+
+    if tforces and not present:
         msg = 'Error while reading ' + FNETOUT + ' file. Forces ' + \
             'requested by the calculator but not present in output.'
         raise FortnetAseError(msg)
 
-    if tforces:
-        # assume a single datapoint and training target
-        # further assume that the target unit was a.u.
-        forces = fnetout.forces[0][0] * HARTREE_EV / BOHR_AA
-    else:
-        forces = None
+
+def _read_forces_direct(output):
+    '''Read forces of the first datapoint and target from fnetout.hdf5 output
+       directly into a freshly allocated array.
+
+    Args:
+
+        output (hdf group): output group of the fnetout.hdf5 file
+
+    Returns:
+
+        forces (2darray): atomic forces (unit: a.u.)
+
+    '''
+
+    dset = output['datapoint1/forces']
+    forces = np.empty((dset.shape[0], 3), dtype=float)
+    dset.read_direct(forces, np.s_[:, 0:3])
 
     return forces
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+#------------------------------------------------------------------------------#
+#  fortnet-ase: Interfacing Fortnet with the Atomic Simulation Environment     #
+#  Copyright (C) 2021 - 2025  T. W. van der Heide                              #
+#                                                                              #
+#  See the LICENSE file for terms of usage and distribution.                   #
+#------------------------------------------------------------------------------#
+
+
+'''Regression tests of the Fortnet file-IO calculator.'''
+
+
+import os
+import shutil
+import subprocess
+import sys
+import h5py
+import numpy as np
+import pytest
+from ase import Atoms
+from ase.build import bulk, molecule
+from ase.calculators.calculator import all_changes
+from fortformat import Fnetdata, Fnetout
+
+from fnetase import Fortnet, FortnetAseError
+from fnetase import calculator
+from fnetase.calculator import AA_BOHR, FORCE_CONV, HARTREE_EV, \
+    hsd_from_file, open_hdf5, read_energy, read_forces, write_fnetdata
+
+
+_TOLERANCE = 1.0e-10
+
+# Fortnet stand-in, predicting E = -natoms (Hartree) and F = coordinates
+_FAKE_FNET = '''
+import h5py
+import numpy as np
+
+with h5py.File('fnetdata.hdf5', 'r') as fnetdata, \\
+     h5py.File('fnetout.hdf5', 'w') as fnetout:
+    dataset = fnetdata['fnetdata/dataset']
+    ndatapoints = int(dataset.attrs['ndatapoints'])
+    root = fnetout.create_group('fnetout')
+    root.attrs['mode'] = np.bytes_(b'predict')
+    output = root.create_group('output')
+    output.attrs['ndatapoints'] = [ndatapoints]
+    output.attrs['nglobaltargets'] = [1]
+    output.attrs['natomictargets'] = [0]
+    output.attrs['tforces'] = [1]
+    for idata in range(ndatapoints):
+        dataname = 'datapoint' + str(idata + 1)
+        coords = dataset[dataname]['geometry/coordinates'][()]
+        output[dataname + '/globalpredictions'] = [-float(len(coords))]
+        output[dataname + '/forces'] = coords
+'''
+
+
+@pytest.fixture(name='netstat')
+def fixture_netstat(tmp_path, monkeypatch):
+    '''Creates a minimal H/O netstat file in a temporary working directory.'''
+
+    monkeypatch.chdir(tmp_path)
+    _write_netstat('netstat.hdf5')
+
+    return 'netstat.hdf5'
+
+
+def _write_netstat(fname, subnetworks=('h', 'o'), topology=(4, 2, 1)):
+    '''Writes a minimal H/O netstat file.
+
+    Args:
+
+        fname (str): name of the netstat file to write
+        subnetworks (tuple): elements to write subnetworks for
+        topology (tuple): topology of all subnetworks
+
+    '''
+
+    with h5py.File(fname, 'w') as netstatfile:
+        bpnn = netstatfile.create_group('netstat/bpnn')
+        bpnn.attrs['nglobaltargets'] = [1]
+        bpnn.attrs['natomictargets'] = [0]
+        bpnn['atomicnumbers'] = np.array([1, 8])
+        for element in subnetworks:
+            bpnn[element + '-subnetwork/topology'] = np.array(topology)
+        netstatfile.create_group('netstat/mapping')
+
+
+@pytest.fixture(name='command')
+def fixture_command(tmp_path):
+    '''Writes a fake Fortnet executable and provides its command.'''
+
+    script = tmp_path / 'fakefnet.py'
+    script.write_text(_FAKE_FNET)
+
+    return sys.executable + ' ' + str(script)
+
+
+def _water(shift=0.0):
+    '''Creates a water molecule, with the oxygen shifted along x.'''
+
+    atoms = molecule('H2O')
+    atoms.positions[0, 0] += shift
+
+    return atoms
+
+
+def _compare_hdf(ref, new):
+    '''Recursively compares groups, datasets and attributes of HDF5 files.'''
+
+    assert set(ref.keys()) == set(new.keys()), ref.name
+    assert set(ref.attrs.keys()) == set(new.attrs.keys()), ref.name
+
+    for key, refattr in ref.attrs.items():
+        newattr = new.attrs[key]
+        assert np.asarray(refattr).dtype.kind == np.asarray(newattr).dtype.kind
+        assert np.all(refattr == newattr), ref.name + ':' + key
+
+    for key in ref:
+        if isinstance(ref[key], h5py.Group):
+            _compare_hdf(ref[key], new[key])
+        else:
+            assert ref[key].dtype == new[key].dtype, ref[key].name
+            assert np.allclose(ref[key][()], new[key][()],
+                               rtol=0.0, atol=_TOLERANCE), ref[key].name
+
+
+def test_write_fnetdata(tmp_path):
+    '''Checks that the dataset layout matches fortformat's Fnetdata.dump().'''
+
+    atoms = [molecule('CH3CH2OH'),
+             bulk('NaCl', 'rocksalt', a=5.64) * (2, 1, 1),
+             molecule('H2O')]
+
+    Fnetdata(atoms=atoms).dump(str(tmp_path / 'ref.hdf5'))
+    write_fnetdata(atoms, str(tmp_path / 'new.hdf5'))
+
+    with h5py.File(tmp_path / 'ref.hdf5', 'r') as ref, \
+         h5py.File(tmp_path / 'new.hdf5', 'r') as new:
+        _compare_hdf(ref, new)
+
+
+def test_calculate_batch(netstat, command):
+    '''Checks batched energies and forces of images with varying size.'''
+
+    images = [_water(), Atoms('OH', positions=[[0, 0, 0], [0, 0, 0.97]]),
+              _water(0.1)]
+
+    calc = Fortnet(restart=netstat, command=command)
+    results = calc.calculate_batch(images, ('energy', 'forces'))
+
+    energies = [-len(atoms) * HARTREE_EV for atoms in images]
+    assert np.allclose(results['energy'], energies, rtol=0.0, atol=_TOLERANCE)
+
+    assert len(results['forces']) == len(images)
+    for forces, atoms in zip(results['forces'], images):
+        assert np.allclose(forces, atoms.positions * AA_BOHR * FORCE_CONV,
+                           rtol=0.0, atol=1.0e-08)
+
+    # batched results must not be handed out for single geometries
+    assert not calc.results
+
+
+def test_single_after_batch(netstat, command):
+    '''Checks that a failed batch doesn't leak into single calculations.'''
+
+    atoms = _water()
+    images = [atoms, Atoms('OH', positions=[[0, 0, 0], [0, 0, 0.97]])]
+
+    # invalid (empty) output, which fails to be read
+    calc = Fortnet(restart=netstat, command='touch fnetout.hdf5')
+    with pytest.raises(OSError):
+        calc.calculate_batch(images, ('energy',))
+
+    # the batch left a list of images behind
+    assert isinstance(calc.atoms, list)
+    assert set(calc.check_state(atoms)) == set(all_changes)
+
+    calc.profile.command = command
+    atoms.calc = calc
+    assert atoms.get_potential_energy() == pytest.approx(-3.0 * HARTREE_EV)
+
+
+def test_empty_batch(netstat, command):
+    '''Checks that an empty list of images is rejected.'''
+
+    calc = Fortnet(restart=netstat, command=command)
+    with pytest.raises(FortnetAseError, match='Empty list of images'):
+        calc.calculate_batch([], ('energy',))
+
+
+@pytest.fixture(name='rewrites')
+def fixture_rewrites(monkeypatch):
+    '''Counts the full (re-)writes of the dataset file.'''
+
+    rewrites = []
+
+    def counting_write_fnetdata(atoms, fname):
+        rewrites.append(fname)
+        write_fnetdata(atoms, fname)
+
+    monkeypatch.setattr(calculator, 'write_fnetdata', counting_write_fnetdata)
+
+    return rewrites
+
+
+def _assert_dataset_matches(atoms, tmp_path):
+    '''Compares the dataset on disk with a full rewrite for the geometry.'''
+
+    write_fnetdata([atoms], str(tmp_path / 'ref.hdf5'))
+
+    # the calculator may keep the dataset open without file locking
+    with h5py.File(tmp_path / 'ref.hdf5', 'r') as ref, \
+         h5py.File(calculator.FNETDATA, 'r', locking=False) as new:
+        _compare_hdf(ref, new)
+
+
+@pytest.mark.parametrize('periodic', [False, True])
+def test_inplace_coordinates(netstat, command, rewrites, tmp_path, periodic):
+    '''Checks in-place coordinate updates in an MD-like loop.'''
+
+    atoms = _water()
+    if periodic:
+        atoms.set_cell(np.diag([6.0, 7.0, 8.0]))
+        atoms.pbc = True
+    atoms.calc = Fortnet(restart=netstat, command=command)
+
+    atoms.get_forces()
+    assert len(rewrites) == 1
+    inode = os.stat(calculator.FNETDATA).st_ino
+
+    for _ in range(3):
+        atoms.positions[0] += [0.05, -0.02, 0.01]
+        forces = atoms.get_forces()
+        _assert_dataset_matches(atoms, tmp_path)
+
+    # coordinates were updated in-place, i.e. the file was never recreated
+    assert len(rewrites) == 1
+    assert os.stat(calculator.FNETDATA).st_ino == inode
+
+    if periodic:
+        expected = atoms.get_scaled_positions() * FORCE_CONV
+    else:
+        expected = atoms.positions * AA_BOHR * FORCE_CONV
+    assert np.allclose(forces, expected, rtol=0.0, atol=1.0e-08)
+
+
+def test_changed_numbers_rewrite(netstat, command, rewrites, tmp_path):
+    '''Checks that changed atomic numbers trigger a full rewrite.'''
+
+    atoms = _water()
+    atoms.calc = Fortnet(restart=netstat, command=command)
+    atoms.get_potential_energy()
+
+    atoms.numbers[1] = 8
+    atoms.get_potential_energy()
+
+    assert len(rewrites) == 2
+    _assert_dataset_matches(atoms, tmp_path)
+
+
+def test_foreign_change_rewrite(netstat, command, rewrites, tmp_path):
+    '''Checks that a dataset modified by someone else is fully rewritten.'''
+
+    atoms = _water()
+    atoms.calc = Fortnet(restart=netstat, command=command)
+    atoms.get_potential_energy()
+
+    atoms.positions[0, 0] += 0.1
+    atoms.get_potential_energy()
+    assert len(rewrites) == 1
+
+    # foreign in-place modification of the dataset, e.g. another calculator
+    with h5py.File(calculator.FNETDATA, 'r+', locking=False) as fnetdata:
+        fnetdata['fnetdata/dataset/datapoint1/geometry/coordinates'][0] = 0.0
+    stat = os.stat(calculator.FNETDATA)
+    os.utime(calculator.FNETDATA,
+             ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+    atoms.positions[0, 0] += 0.1
+    atoms.get_potential_energy()
+
+    assert len(rewrites) == 2
+    _assert_dataset_matches(atoms, tmp_path)
+
+
+def test_shared_hsd_input(netstat, command):
+    '''Checks that calculators sharing a directory use their own netstat.'''
+
+    shutil.copy(netstat, 'a.hdf5')
+    shutil.copy(netstat, 'b.hdf5')
+
+    atoms_a = _water()
+    atoms_a.calc = Fortnet(restart='a.hdf5', command=command)
+    atoms_b = _water()
+    atoms_b.calc = Fortnet(restart='b.hdf5', command=command)
+
+    atoms_a.get_potential_energy()
+    atoms_b.get_potential_energy()
+
+    atoms_a.positions[0, 0] += 0.1
+    atoms_a.get_potential_energy()
+
+    inp = hsd_from_file('fortnet_in.hsd')
+    assert inp['Data']['NetstatFile'] == 'a.hdf5'
+
+
+def test_read_reused_fnetout(netstat, command):
+    '''Checks reading results from an already opened fnetout.hdf5 file.'''
+
+    write_fnetdata([_water(0.1)], calculator.FNETDATA)
+    subprocess.run(command, shell=True, check=True)
+
+    energy = read_energy()
+    forces = read_forces(True)
+    assert energy == pytest.approx(-3.0 * HARTREE_EV)
+
+    fnetout = Fnetout(calculator.FNETOUT)
+    assert read_energy(fnetout) == pytest.approx(energy)
+    assert np.allclose(read_forces(True, fnetout), forces,
+                       rtol=0.0, atol=_TOLERANCE)
+
+    with open_hdf5(calculator.FNETOUT) as fnetoutfile:
+        assert read_energy(fnetoutfile) == pytest.approx(energy)
+        assert np.allclose(read_forces(True, fnetoutfile), forces,
+                           rtol=0.0, atol=_TOLERANCE)
+        assert read_forces(False, fnetoutfile) is None
+
+    # requested forces, missing in the output
+    with h5py.File(calculator.FNETOUT, 'r+') as fnetoutfile:
+        fnetoutfile['fnetout/output'].attrs['tforces'] = [0]
+    with pytest.raises(FortnetAseError):
+        read_forces(True, Fnetout(calculator.FNETOUT))
+    with pytest.raises(FortnetAseError):
+        read_forces(True)
+
+
+@pytest.mark.parametrize('subnetworks, topology, msg', [
+    (('h',), (4, 2, 1), 'Missing subnetwork(s): o-subnetwork.'),
+    (('h', 'o'), (4, 2, 2), 'single global property')])
+def test_invalid_netstat(netstat, command, subnetworks, topology, msg):
+    '''Checks the rejection of netstat files with unsupported networks.'''
+
+    _write_netstat(netstat, subnetworks=subnetworks, topology=topology)
+
+    atoms = _water()
+    atoms.calc = Fortnet(restart=netstat, command=command)
+
+    with pytest.raises(FortnetAseError) as excinfo:
+        atoms.get_potential_energy()
+    assert msg in str(excinfo.value)
+
+
+def test_netstat_check_cache(netstat, command, monkeypatch):
+    '''Checks that the netstat file is only validated again on changes.'''
+
+    checks = []
+    check_bpnn_configuration = calculator._check_bpnn_configuration
+
+    def counting_check(fname, tforces):
+        checks.append((fname, tforces))
+        check_bpnn_configuration(fname, tforces)
+
+    monkeypatch.setattr(calculator, '_check_bpnn_configuration',
+                        counting_check)
+
+    atoms = _water()
+    atoms.calc = Fortnet(restart=netstat, command=command)
+
+    atoms.get_potential_energy()
+    atoms.positions[0, 0] += 0.1
+    atoms.get_potential_energy()
+    assert checks == [(netstat, False)]
+
+    # switching on forces
+    atoms.positions[0, 0] += 0.1
+    atoms.get_forces()
+    assert checks[-1] == (netstat, True)
+    assert len(checks) == 2
+
+    # touching the netstat file
+    stat = os.stat(netstat)
+    os.utime(netstat, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    atoms.positions[0, 0] += 0.1
+    atoms.get_forces()
+    assert len(checks) == 3
+
+    # replacing the netstat file by an invalid one
+    _write_netstat('replaced.hdf5', topology=(4, 2, 2))
+    os.replace('replaced.hdf5', netstat)
+    os.utime(netstat, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2000000000))
+    atoms.positions[0, 0] += 0.1
+    with pytest.raises(FortnetAseError):
+        atoms.get_forces()
+    assert len(checks) == 4
+
+
+@pytest.mark.parametrize('truncate', [True, False])
+def test_fnetout_cleanup(netstat, command, truncate):
+    '''Checks that fnetout.hdf5 is truncated or removed after reading.'''
+
+    atoms = _water()
+    atoms.calc = Fortnet(restart=netstat, command=command,
+                         truncate_fnetout=truncate)
+    atoms.get_potential_energy()
+
+    if truncate:
+        assert os.path.getsize(calculator.FNETOUT) == 0
+    else:
+        assert not os.path.exists(calculator.FNETOUT)
+
+
+def test_results_not_mutated(netstat, command):
+    '''Checks that kept results stay valid after further steps.'''
+
+    atoms = _water()
+    atoms.calc = Fortnet(restart=netstat, command=command)
+
+    atoms.get_forces()
+    results = dict(atoms.calc.results)
+    forces = results['forces'].copy()
+
+    atoms.positions[0, 0] += 0.1
+    atoms.get_forces()
+
+    assert results['forces'] is not atoms.calc.results['forces']
+    assert np.array_equal(results['forces'], forces)
+
+
+if __name__ == '__main__':
+    pytest.main()